@@ -5,9 +5,9 @@ os.environ["TORCH_CUDNN_SDPA_ENABLED"] = "1"
 
 import argparse
 import functools
-import math
 import random
 import shutil
+import sys
 import numpy as np
 import time
 import warnings
@@ -80,6 +80,9 @@ parser.add_argument('--input-resolution', default=224, type=int, metavar='RES',
 parser.add_argument('--patch-size', default=16, type=int, metavar='PS')
 parser.add_argument('--num-layers', default=12, type=int, metavar='N')
 parser.add_argument('--num-heads', default=6, type=int, metavar='N')
+parser.add_argument('--head-dim', default=None, type=int, metavar='N',
+                    help='Set --num-heads to --hidden-dim / N, e.g. 64 or 128 to match the '
+                         'FlashAttention kernel templates')
 parser.add_argument('--posemb', default='sincos2d', type=str,
                     choices=['none', 'sincos2d', 'learn'])
 parser.add_argument('--mlp-head', action='store_true',
@@ -145,6 +148,14 @@ parser.add_argument('--randaug', action='store_true', default=True,
 parser.add_argument('--no-randaug', action='store_false', dest='randaug',
                     help='Do not use RandAug')
 parser.add_argument("--randaug-magnitude", default=10, type=int)
+parser.add_argument('--gpu-randaug', action='store_true',
+                    help='Apply RandAug to the uint8 batch on the GPU instead of in the data loading '
+                         'workers. Ops are still sampled per image, but applied once per group of images '
+                         'that drew the same op.')
+parser.add_argument('--pin-memory', action='store_true', default=True,
+                    help='Use pinned host memory for the data loaders (default: True)')
+parser.add_argument('--no-pin-memory', action='store_false', dest='pin_memory',
+                    help='Do not pin host memory, e.g. when /dev/shm is limited in a container')
 parser.add_argument('-p', '--print-freq', default=100, type=int,
                     metavar='N', help='print frequency (default: 100)')
 parser.add_argument('--resume', default='', type=str, metavar='PATH',
@@ -186,15 +197,46 @@ parser.add_argument('--no-amp', action='store_false', dest='amp',
 parser.add_argument('--amp-dtype', type=str, default='bfloat16',
                     choices=['float16', 'bfloat16'],
                     help='Data type to use with AMP (default: float16)')
+parser.add_argument('--compile', action='store_true', default=True,
+                    help='Compile the model with torch.compile(mode="max-autotune") (default: True)')
+parser.add_argument('--no-compile', action='store_false', dest='compile',
+                    help='Run the model eagerly')
+parser.add_argument('--bf16-weights', action='store_true',
+                    help='Keep all weights but the LayerNorms in bfloat16 and feed bfloat16 inputs '
+                         'instead of running under autocast. Note that the optimizer then updates '
+                         'the bfloat16 weights directly, there is no float32 master copy.')
+parser.add_argument('--grad-checkpoint', action='store_true',
+                    help='Recompute the activations of each encoder block in backward, trading about '
+                         'one extra forward pass for memory, e.g. to fit a larger batch')
 best_acc1 = 0
+# forkserver starts DataLoader workers from a warm server process instead of a fresh
+# interpreter each, while staying as safe as spawn w.r.t. CUDA state. Linux only.
+mp_context = 'forkserver' if sys.platform == 'linux' else 'spawn'
 
 
-def collate(batch, mixup):
-    return mixup(*torch.utils.data.default_collate(batch))
+def fast_collate(batch):
+    """Collates uint8 CHW images into one preallocated uint8 batch. Float cast,
+    normalization and MixUp are deferred to the training device.
+    """
+    shape = (len(batch), *batch[0][0].shape)
+    if torch.utils.data.get_worker_info() is not None:
+        # Like default_collate(), allocate the batch in shared memory up front so that
+        # sending it to the main process doesn't copy it again
+        storage = torch.UntypedStorage._new_shared(torch.Size(shape).numel())
+        images = torch.empty(0, dtype=torch.uint8).set_(storage).view(shape)
+    else:
+        images = torch.empty(shape, dtype=torch.uint8)
+    for i, (img, _) in enumerate(batch):
+        images[i].copy_(img)
+    targets = torch.tensor([target for _, target in batch], dtype=torch.int64)
+    return images, targets
 
 
 def chunk(n, device, *tensors):
-    tensors = tuple(t.to(device=device, non_blocking=True) for t in tensors)
+    # Images go channels_last so that the patchify conv picks NHWC kernels
+    tensors = tuple(t.to(device=device, non_blocking=True,
+                         memory_format=torch.channels_last if t.dim() == 4 else torch.preserve_format)
+                    for t in tensors)
     if n == 1:
         yield tensors
     else:
@@ -203,6 +245,11 @@ def chunk(n, device, *tensors):
 
 def main():
     args = parser.parse_args()
+
+    if args.head_dim is not None:
+        if args.hidden_dim % args.head_dim:
+            parser.error(f'--hidden-dim {args.hidden_dim} is not divisible by --head-dim {args.head_dim}')
+        args.num_heads = args.hidden_dim // args.head_dim
     
     if not args.mlp_head:
         args.representation_size = None
@@ -270,6 +317,30 @@ def weight_decay_param(n, p):
     return p.ndim >= 2 and n.endswith('weight')
 
 
+def cast_to_bf16(model):
+    """Casts the model to bfloat16, except for the LayerNorms which stay in float32"""
+    model.to(dtype=torch.bfloat16)
+    for m in model.modules():
+        if isinstance(m, nn.LayerNorm):
+            m.float()
+    return model
+
+
+def get_input_dtype(args):
+    if args.bf16_weights:
+        return torch.bfloat16
+    if args.amp:
+        return torch.bfloat16 if args.amp_dtype == 'bfloat16' else torch.float16
+    return torch.float32
+
+
+def get_value_range(device, dtype):
+    """mean and std of value_range, i.e. v2.Normalize(0.5, 0.5), for normalize()"""
+    mean = torch.tensor([0.5] * 3, device=device, dtype=dtype).view(1, 3, 1, 1)
+    std = torch.tensor([0.5] * 3, device=device, dtype=dtype).view(1, 3, 1, 1)
+    return mean, std
+
+
 def main_worker(gpu, args):
     global best_acc1
     args.gpu = gpu
@@ -285,7 +356,10 @@ def main_worker(gpu, args):
             # global rank among all the processes
             args.rank = args.rank * args.ngpus_per_node + gpu
     if args.distributed or args.ngpus_per_node > 1:
-        os.environ['CUDA_VISIBLE_DEVICES'] = str(args.rank)
+        if torch.cuda.is_available():
+            # Pin the process to its GPU, the plain "cuda" device used below then refers to it.
+            # Without --multiprocessing-distributed (e.g. torchrun) the launcher provides LOCAL_RANK.
+            torch.cuda.set_device(args.gpu if args.gpu is not None else int(os.environ.get("LOCAL_RANK", 0)))
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
     # create model
@@ -300,7 +374,12 @@ def main_worker(gpu, args):
         representation_size=args.representation_size,
         pool_type=args.pool_type,
         register=args.register,
+        grad_checkpoint=args.grad_checkpoint,
     )
+    if args.bf16_weights:
+        cast_to_bf16(model)
+        # Weights and inputs are already bfloat16, autocast would only add casts and guards
+        args.amp = False
 
     wd_params = [p for n, p in model.named_parameters() if weight_decay_param(n, p) and p.requires_grad]
     non_wd_params = [p for n, p in model.named_parameters() if not weight_decay_param(n, p) and p.requires_grad]
@@ -313,6 +392,7 @@ def main_worker(gpu, args):
         args.amp = False
     elif torch.cuda.is_available():
         model.cuda()
+        model = model.to(memory_format=torch.channels_last)
         device = torch.device("cuda")
         if args.distributed or args.ngpus_per_node > 1:
             # For multiprocessing distributed, DistributedDataParallel constructor
@@ -331,6 +411,11 @@ def main_worker(gpu, args):
         # AMP has limited support on MPS, disable it if not using CUDA
         args.amp = False
 
+    # The compiled model is specialized to (and graph-captured for) one microbatch shape,
+    # uneven chunk() splits would force extra compilations and graph captures
+    if args.batch_size % args.accum_freq:
+        raise ValueError(f'Per-GPU batch size {args.batch_size} is not divisible by --accum-freq {args.accum_freq}')
+
     if args.decoupled_weight_decay:
         args.weight_decay /= args.lr
 
@@ -346,36 +431,32 @@ def main_worker(gpu, args):
             betas=(args.beta1, args.beta2),
             warmup_steps=args.warmup,
             r=args.polynomial_weighting_power,
+            foreach=True,
         )
         optimizer.train()
     else:
+        # The fused kernel updates all parameters in a single multi-tensor launch
         optimizer = torch.optim.AdamW(
             params,
             lr=args.lr,
-            betas=(args.beta1, args.beta2)
+            betas=(args.beta1, args.beta2),
+            fused=torch.cuda.is_available(),
         )
 
-    # Initialize the GradScaler for AMP
-    scaler = GradScaler() if args.amp else None
-    
     # Set AMP dtype based on user choice
     amp_dtype = torch.bfloat16 if args.amp_dtype == 'bfloat16' else torch.float16
+
+    # Initialize the GradScaler for AMP. bfloat16 has the exponent range of float32 and doesn't need loss scaling
+    scaler = GradScaler() if args.amp and amp_dtype == torch.float16 else None
     
     # Data loading code
+    gpu_transform = None
     if args.fake_data:
         print("=> Fake data is used!")
         input_shape = (3, args.input_resolution, args.input_resolution)
-        transform = v2.Compose([
-            v2.ToImage(),
-            v2.ToDtype(torch.float32, scale=True),
-        ])
-        train_dataset = datasets.FakeData(1281167, input_shape, 1000, transform)
-        val_dataset = datasets.FakeData(50000, input_shape, 1000, transform)
+        train_dataset = datasets.FakeData(1281167, input_shape, 1000, v2.ToImage())
+        val_dataset = datasets.FakeData(50000, input_shape, 1000, v2.ToImage())
     else:
-        value_range = v2.Normalize(
-            mean=[0.5] * 3,
-            std=[0.5] * 3)
-
         cutout_const = 40
         translate_const = 100
         MAX_LEVEL = 10
@@ -413,12 +494,11 @@ def main_worker(gpu, args):
             inception_crop(args.input_resolution, scale=(args.lower_scale, args.upper_scale)),
             v2.RandomHorizontalFlip()
         ]
-        if args.randaug:
+        if args.randaug and args.gpu_randaug:
+            gpu_transform = randaug.forward_batch
+        elif args.randaug:
             transform.append(randaug)
-        transform.extend([
-            v2.ToDtype(torch.float32, scale=True),
-            value_range
-        ])
+        # Images stay uint8 here; ToDtype() and value_range are applied on the device by normalize()
 
         train_dataset = datasets.ImageNet(args.data, split='train', transform=v2.Compose(transform))
 
@@ -429,8 +509,6 @@ def main_worker(gpu, args):
                 v2.ToImage(),
                 v2.Resize(256),
                 v2.CenterCrop(args.input_resolution),
-                v2.ToDtype(torch.float32, scale=True),
-                value_range,
             ]))
 
     n = len(train_dataset)
@@ -446,18 +524,28 @@ def main_worker(gpu, args):
         val_sampler = None
 
     mixup = TwoHotMixUp(alpha=args.mixup_alpha, prefetch_factor=args.prefetch_factor, batch_size=args.batch_size)
-    collate_fn = functools.partial(collate, mixup=mixup)
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=args.prefetch_factor * args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler,
-        collate_fn=collate_fn, drop_last=True, multiprocessing_context='spawn',
+        num_workers=args.workers, pin_memory=args.pin_memory, sampler=train_sampler,
+        collate_fn=fast_collate, drop_last=True, multiprocessing_context=mp_context,
         prefetch_factor=1, persistent_workers=True)
 
     val_loader = torch.utils.data.DataLoader(
         val_dataset, batch_size=args.prefetch_factor * args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True, sampler=val_sampler,
-        multiprocessing_context='spawn', prefetch_factor=1)
+        num_workers=args.workers, pin_memory=args.pin_memory, sampler=val_sampler,
+        collate_fn=fast_collate, multiprocessing_context=mp_context, prefetch_factor=2, persistent_workers=True)
+
+    # DistributedSampler(drop_last=True) leaves out the tail of the val set, every rank
+    # evaluates it on top of the all-reduced results. Built once so its workers persist.
+    aux_val_loader = None
+    if args.distributed and (len(val_sampler) * args.world_size < len(val_dataset)):
+        aux_val_dataset = Subset(val_dataset, range(len(val_sampler) * args.world_size, len(val_dataset)))
+        aux_val_loader = torch.utils.data.DataLoader(
+            aux_val_dataset, batch_size=args.batch_size, shuffle=False,
+            num_workers=args.workers, pin_memory=args.pin_memory, collate_fn=fast_collate,
+            multiprocessing_context=mp_context if args.workers > 0 else None,
+            prefetch_factor=2 if args.workers > 0 else None, persistent_workers=args.workers > 0)
 
     if args.schedule_free:
         scheduler = None
@@ -477,7 +565,7 @@ def main_worker(gpu, args):
             optimizer.load_state_dict(checkpoint['optimizer'])
             if not args.schedule_free:
                 scheduler.load_state_dict(checkpoint['scheduler'])
-            if 'scaler' in checkpoint and args.amp:
+            if 'scaler' in checkpoint and scaler is not None:
                 scaler.load_state_dict(checkpoint['scaler'])
             print("=> loaded checkpoint '{}' (step {})"
                   .format(args.resume, checkpoint['step']))
@@ -500,22 +588,25 @@ def main_worker(gpu, args):
     # Pytorch 2.0 adds '_orig_mod.' prefix to keys of state_dict() of compiled models.
     # For compatibility, we save state_dict() of the original model, which shares the
     # weights without the prefix.
-    print('Compiling model...')
     original_model = model
 
-    model = torch.compile(original_model)
-
-    # model = torch.compile(
-    #     original_model, backend= "inductor", mode="reduce-overhead")  
+    if args.compile:
+        print('Compiling model...')
+        # Every step sees the same (batch_size // accum_freq, 3, H, W) input (drop_last=True), so
+        # compile for static shapes and let max-autotune pick kernels. max-autotune also replays the
+        # forward/backward as CUDA graphs, but only while every tensor input is on the GPU
+        # (TwoHotMixUp returns lam on the device for this reason).
+        model = torch.compile(original_model, mode="max-autotune", fullgraph=True, dynamic=False)
 
 
     if args.evaluate:
         # evaluate on validation set.
-        validate(val_loader, model, args.start_step, device, args)
+        validate(val_loader, model, args.start_step, device, args, aux_val_loader)
         return
 
     train(train_loader, train_sampler, val_loader, args.start_step, total_steps, 
-          original_model, model, optimizer, scheduler, device, args, scaler, amp_dtype)
+          original_model, model, optimizer, scheduler, device, args, scaler, amp_dtype, mixup, gpu_transform,
+          aux_val_loader)
 
 
 def infinite_loader(loader, sampler):
@@ -527,8 +618,69 @@ def infinite_loader(loader, sampler):
         epoch += 1
 
 
+def normalize(images, mean, std, dtype):
+    """uint8 -> dtype in [0, 1] -> value_range, in channels_last so that the patchify conv
+    picks NHWC kernels. The uint8 input is converted rather than the larger float output."""
+    images = images.contiguous(memory_format=torch.channels_last)
+    return (images.to(dtype) / 255.0 - mean) / std
+
+
+@functools.lru_cache(maxsize=None)
+def get_normalize(compile):
+    """normalize(), fused by Inductor into a single elementwise kernel unless --no-compile.
+    Cached so that train() and validate() share one compiled function."""
+    return torch.compile(normalize, dynamic=False) if compile else normalize
+
+
+class CUDAPrefetcher(object):
+    """Copies, optionally transforms (the whole batch, still uint8) and normalizes the next batch
+    on a side CUDA stream while the current batch is being computed on. Falls back to inline
+    copies off CUDA.
+    """
+    def __init__(self, loader, device, mean, std, dtype=torch.float32, transform=None, normalize=normalize):
+        self.loader = loader
+        self.device = device
+        self.mean = mean
+        self.std = std
+        self.dtype = dtype
+        self.transform = transform
+        self.normalize = normalize
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def _stage(self, images, targets):
+        images = images.to(self.device, non_blocking=True)
+        if self.transform is not None:
+            images = self.transform(images)
+        images = self.normalize(images, self.mean, self.std, self.dtype)
+        targets = targets.to(self.device, non_blocking=True)
+        return images, targets
+
+    def __iter__(self):
+        if self.stream is None:
+            for images, targets in self.loader:
+                yield self._stage(images, targets)
+            return
+
+        # mean/std (and anything else set up on the main stream) must be ready before staging
+        self.stream.wait_stream(torch.cuda.current_stream())
+        batch = None
+        for next_images, next_targets in self.loader:
+            with torch.cuda.stream(self.stream):
+                next_batch = self._stage(next_images, next_targets)
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream().wait_stream(self.stream)
+            # Tell the caching allocator that these side-stream tensors are used on the main stream
+            for t in next_batch:
+                t.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
+
 def train(train_loader, train_sampler, val_loader, start_step, total_steps, 
-          original_model, model, optimizer, scheduler, device, args, scaler, amp_dtype):
+          original_model, model, optimizer, scheduler, device, args, scaler, amp_dtype, mixup, gpu_transform=None,
+          aux_val_loader=None):
     batch_time = AverageMeter('Time', device, ':6.3f')
     data_time = AverageMeter('Data', device, ':6.3f')
     losses = AverageMeter('Loss', device, ':.4e')
@@ -539,21 +691,43 @@ def train(train_loader, train_sampler, val_loader, start_step, total_steps,
     # switch to train mode
     model.train()
     end = time.time()
+    step_timer = StepTimer(device)
+    step_timer.start(start_step)
     best_acc1 = 0
-    # generator moves data to the same device as model
-    gen = (
-        (images, lam, target1, target2) for (img, lam, trt1, trt2) in infinite_loader(train_loader, train_sampler) for images, target1, target2 in zip(
-            img.to(device, non_blocking=True),
-            trt1.to(device, non_blocking=True),
-            trt2.to(device, non_blocking=True))
-    )
+    # foreach=True raises on devices without multi-tensor kernels, e.g. CPU
+    foreach = device.type == 'cuda'
+    # Inputs are cast straight to the autocast (or weight) dtype, conv_proj would do that anyway
+    input_dtype = get_input_dtype(args)
+    mean, std = get_value_range(device, input_dtype)
+    # prefetcher moves data to the same device as model and normalizes it there, generator mixes it up
+    prefetcher = CUDAPrefetcher(infinite_loader(train_loader, train_sampler), device, mean, std, input_dtype,
+                                transform=gpu_transform, normalize=get_normalize(args.compile))
+    mixed = (mixup(img, trt) for img, trt in prefetcher)
+    if args.prefetch_factor == 1:
+        # Each loader batch is exactly one step, no need to split it along the prefetch_factor axis
+        gen = ((img[0], lam, trt1[0], trt2[0]) for img, lam, trt1, trt2 in mixed)
+    else:
+        # mixup() returns (prefetch_factor, batch_size, ...) tensors that were copied to the device
+        # in one go, zip() walks the prefetch_factor axis and yields whole batches, not samples
+        gen = (
+            (images, lam, target1, target2)
+            for (img, lam, trt1, trt2) in mixed
+            for images, target1, target2 in zip(img, trt1, trt2)
+        )
 
     for step, (images, lam, target1, target2) in zip(range(start_step + 1, total_steps + 1), gen):
-        # measure data loading time
-        data_time.update(time.time() - end)
-        step_loss = 0.0
+        # measure data loading time of the steps that get logged
+        if step % args.print_freq == 0:
+            data_time.update(time.time() - end)
+        # Accumulated on the device, it is only synced to the host when logged
+        step_loss = torch.zeros((), device=device)
 
-        for img, trt1, trt2 in chunk(args.accum_freq, device, images, target1, target2):
+        if args.accum_freq == 1:
+            microbatches = ((images, target1, target2),)
+        else:
+            microbatches = chunk(args.accum_freq, device, images, target1, target2)
+
+        for img, trt1, trt2 in microbatches:
             # Use autocast for mixed precision where supported
             if args.amp:
                 with autocast(device_type=device.type, dtype=amp_dtype):
@@ -563,16 +737,19 @@ def train(train_loader, train_sampler, val_loader, start_step, total_steps,
                     loss = loss / args.accum_freq
                 
                 # record loss
-                step_loss += loss.item() * args.accum_freq
+                step_loss += loss.detach() * args.accum_freq
                 
                 # Scales the loss, and calls backward() to create scaled gradients
-                scaler.scale(loss).backward()
+                if scaler is not None:
+                    scaler.scale(loss).backward()
+                else:
+                    loss.backward()
             else:
                 # compute output with full precision
                 _, loss = model(img, lam, trt1, trt2)
                 
                 # record loss
-                step_loss += loss.item()
+                step_loss += loss.detach()
                 
                 # compute gradient
                 (loss / args.accum_freq).backward()
@@ -580,25 +757,24 @@ def train(train_loader, train_sampler, val_loader, start_step, total_steps,
         losses.update(step_loss, images.size(0))
 
         # do SGD step
-        if args.amp:
+        if scaler is not None:
             # Unscales gradients and clips as needed
             scaler.unscale_(optimizer)
-            l2_grads = torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip_norm)
+            l2_grads = torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip_norm, foreach=foreach)
             
             # Update parameters and update the scaler
             scaler.step(optimizer)
             scaler.update()
         else:
-            l2_grads = torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip_norm)
+            l2_grads = torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip_norm, foreach=foreach)
             optimizer.step()
-            
-        optimizer.zero_grad()
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+        # Drop the grads instead of zero-filling them; the next backward allocates fresh ones
+        optimizer.zero_grad(set_to_none=True)
 
         if step % args.print_freq == 0:
+            # measure elapsed time, averaged over the steps since the last log
+            batch_time.update(*step_timer.lap(step))
             progress.display(step)
             
             # Estimate time to completion
@@ -607,33 +783,36 @@ def train(train_loader, train_sampler, val_loader, start_step, total_steps,
 
             if args.wandb and is_primary(args):
                 with torch.no_grad():
-                    l2_params = sum(p.square().sum().item() for _, p in model.named_parameters())
+                    # One multi-tensor norm kernel and a single host sync
+                    l2_params = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(list(model.parameters())))).item()
 
                 samples_per_second_per_gpu = args.batch_size / batch_time.val
                 samples_per_second = samples_per_second_per_gpu * args.world_size
                 log_data = {
-                    "train/loss": step_loss,
+                    "train/loss": step_loss.item(),
                     "data_time": data_time.val,
                     "batch_time": batch_time.val,
                     "samples_per_second": samples_per_second,
                     "samples_per_second_per_gpu": samples_per_second_per_gpu,
                     "l2_grads": l2_grads.item(),
-                    "l2_params": math.sqrt(l2_params),
+                    "l2_params": l2_params,
                     "time_to_completion": time_to_completion
                 }
                 if scheduler:
                     log_data["lr"] = scheduler.get_last_lr()[0]
-                # Add AMP scale factor to logs if using AMP
-                if args.amp:
+                # Add AMP scale factor to logs if using loss scaling
+                if scaler is not None:
                     log_data["amp_scale"] = scaler.get_scale()
                 wandb.log(log_data, step=step)
         if step % args.log_steps == 0 or step in args.specified_steps:
             if args.schedule_free:
                 optimizer.eval()
-                acc1 = validate(val_loader, model, step, device, args)
+                acc1 = validate(val_loader, model, step, device, args, aux_val_loader)
                 optimizer.train()
             else:
-                acc1 = validate(val_loader, model, step, device, args)
+                acc1 = validate(val_loader, model, step, device, args, aux_val_loader)
+            # validate() switched to eval mode, which would also turn off dropout and --grad-checkpoint
+            model.train()
 
             # remember best acc@1 and save checkpoint
             is_best = acc1 > best_acc1
@@ -648,22 +827,30 @@ def train(train_loader, train_sampler, val_loader, start_step, total_steps,
                 }
                 if scheduler:
                     ckpt['scheduler'] = scheduler.state_dict()
-                if args.amp and scaler is not None:
+                if scaler is not None:
                     ckpt['scaler'] = scaler.state_dict()
                 # Always save a step-specific checkpoint whenever validation occurs
                 save_checkpoint(ckpt, is_best, args.checkpoint_path, step=step)
 
+            # keep validation and checkpointing out of the step time
+            step_timer.start(step)
+
         if scheduler:
             scheduler.step()
 
-def validate(val_loader, model, step, device, args):
+        if (step + 1) % args.print_freq == 0:
+            end = time.time()
+
+def validate(val_loader, model, step, device, args, aux_val_loader=None):
 
     def run_validate(loader, base_progress=0):
-        with torch.no_grad():
+        with torch.inference_mode():
             torch.cuda.empty_cache()
             end = time.time()
-            # generator moves data to the same device as model
-            gen = (b for images, target in loader for b in chunk(args.prefetch_factor, device, images, target))
+            # prefetcher overlaps the H2D copy and normalization of the next batch with the current one
+            prefetcher = CUDAPrefetcher(loader, device, mean, std, input_dtype,
+                                        normalize=get_normalize(args.compile))
+            gen = (b for images, target in prefetcher for b in chunk(args.prefetch_factor, device, images, target))
             for i, (images, target) in enumerate(gen):
                 i = base_progress + i
                 for img, trt in chunk(args.accum_freq, device, images, target):
@@ -675,11 +862,12 @@ def validate(val_loader, model, step, device, args):
                     else:
                         output, loss = model(img, 1.0, trt, trt)
 
-                    # measure accuracy and record loss
+                    # measure accuracy and record loss. The meters keep device tensors,
+                    # which are only synced to the host when printed
                     acc1, acc5 = accuracy(output, trt, topk=(1, 5))
-                    losses.update(loss.item(), img.size(0))
-                    top1.update(acc1[0].item(), img.size(0))
-                    top5.update(acc5[0].item(), img.size(0))
+                    losses.update(loss, img.size(0))
+                    top1.update(acc1[0], img.size(0))
+                    top5.update(acc5[0], img.size(0))
                     
                 # measure elapsed time
                 batch_time.update(time.time() - end)
@@ -688,12 +876,17 @@ def validate(val_loader, model, step, device, args):
                 if i % args.print_freq == 0:
                     progress.display(i)
 
+    input_dtype = get_input_dtype(args)
+    mean, std = get_value_range(device, input_dtype)
     batch_time = AverageMeter('Time', device, ':6.3f', Summary.NONE)
     losses = AverageMeter('Loss', device, ':.4e', Summary.NONE)
     top1 = AverageMeter('Acc@1', device, ':6.2f', Summary.AVERAGE)
     top5 = AverageMeter('Acc@5', device, ':6.2f', Summary.AVERAGE)
+    # run_validate() splits every loader batch into prefetch_factor batches
+    num_batches = args.prefetch_factor * len(val_loader)
+    num_aux_batches = args.prefetch_factor * len(aux_val_loader) if aux_val_loader is not None else 0
     progress = ProgressMeter(
-        args.prefetch_factor * len(val_loader) + (args.distributed and (len(val_loader.sampler) * args.world_size < len(val_loader.dataset))),
+        num_batches + num_aux_batches,
         [batch_time, losses, top1, top5],
         prefix='Test: ')
 
@@ -702,28 +895,27 @@ def validate(val_loader, model, step, device, args):
 
     run_validate(val_loader)
     if args.distributed:
-        top1.all_reduce()
-        top5.all_reduce()
+        # One collective for all meters instead of one per meter
+        meters = [top1, top5, losses]
+        packed = torch.stack([m.pack() for m in meters])
+        dist.all_reduce(packed, dist.ReduceOp.SUM, async_op=False)
+        for m, total in zip(meters, packed.unbind(0)):
+            m.unpack(total)
 
-    if args.distributed and (len(val_loader.sampler) * args.world_size < len(val_loader.dataset)):
-        aux_val_dataset = Subset(val_loader.dataset,
-                                 range(len(val_loader.sampler) * args.world_size, len(val_loader.dataset)))
-        aux_val_loader = torch.utils.data.DataLoader(
-            aux_val_dataset, batch_size=args.batch_size, shuffle=False,
-            num_workers=args.workers, pin_memory=True, multiprocessing_context='spawn')
-        run_validate(aux_val_loader, len(val_loader))
+    if aux_val_loader is not None:
+        run_validate(aux_val_loader, num_batches)
 
     progress.display_summary()
 
     if args.wandb and is_primary(args):
         log_data = {
-            'val/loss': losses.avg,
-            'val/acc@1': top1.avg,
-            'val/acc@5': top5.avg,
+            'val/loss': float(losses.avg),
+            'val/acc@1': float(top1.avg),
+            'val/acc@5': float(top5.avg),
         }
         wandb.log(log_data, step=step)
 
-    return top1.avg
+    return float(top1.avg)
 
 
 def save_checkpoint(state, is_best, path, filename='checkpoint.pth.tar', step=None):
@@ -734,6 +926,36 @@ def save_checkpoint(state, is_best, path, filename='checkpoint.pth.tar', step=No
     if step is not None:
         shutil.copyfile(filename, os.path.join(path, f'model_step_{step}.pth.tar'))
 
+class StepTimer(object):
+    """Measures the average step time over a window of steps. Uses CUDA events on CUDA,
+    so that it neither needs per-step host timestamps nor syncs before the window ends.
+    """
+    def __init__(self, device):
+        self.use_events = device.type == 'cuda'
+        if self.use_events:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.end_event = torch.cuda.Event(enable_timing=True)
+
+    def start(self, step):
+        self.start_step = step
+        if self.use_events:
+            self.start_event.record()
+        else:
+            self.start_time = time.time()
+
+    def lap(self, step):
+        """Returns (seconds per step, number of steps) since start() and starts a new window at step"""
+        if self.use_events:
+            self.end_event.record()
+            self.end_event.synchronize()
+            elapsed = self.start_event.elapsed_time(self.end_event) / 1000
+        else:
+            elapsed = time.time() - self.start_time
+        n = max(step - self.start_step, 1)
+        self.start(step)
+        return elapsed / n, n
+
+
 class Summary(Enum):
     NONE = 0
     AVERAGE = 1
@@ -741,7 +963,8 @@ class Summary(Enum):
     COUNT = 3
 
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value. Values may be device tensors,
+    they are then only synced to the host when the meter is printed or packed."""
     def __init__(self, name, device, fmt=':f', summary_type=Summary.AVERAGE):
         self.name = name
         self.fmt = fmt
@@ -751,7 +974,6 @@ class AverageMeter(object):
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -759,17 +981,27 @@ class AverageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        # Computed when read rather than on every update(), which for device tensors is a kernel launch
+        return self.sum / self.count if self.count else 0.0
+
+    def pack(self):
+        return torch.stack([torch.as_tensor(self.sum, dtype=torch.float32, device=self.device),
+                            torch.as_tensor(self.count, dtype=torch.float32, device=self.device)])
+
+    def unpack(self, total):
+        self.sum, self.count = total.tolist()
 
     def all_reduce(self):
-        total = torch.tensor([self.sum, self.count], dtype=torch.float32, device=self.device)
+        total = self.pack()
         dist.all_reduce(total, dist.ReduceOp.SUM, async_op=False)
-        self.sum, self.count = total.tolist()
-        self.avg = self.sum / self.count
+        self.unpack(total)
 
     def __str__(self):
         fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
-        return fmtstr.format(**self.__dict__)
+        return fmtstr.format(**self.__dict__, avg=self.avg)
     
     def summary(self):
         fmtstr = ''
@@ -784,7 +1016,7 @@ class AverageMeter(object):
         else:
             raise ValueError('invalid summary type %r' % self.summary_type)
         
-        return fmtstr.format(**self.__dict__)
+        return fmtstr.format(**self.__dict__, avg=self.avg)
 
 
 class ProgressMeter(object):
@@ -810,19 +1042,17 @@ class ProgressMeter(object):
 
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
-    with torch.no_grad():
+    with torch.inference_mode():
         maxk = max(topk)
         batch_size = target.size(0)
         
         _, pred = output.topk(maxk, 1, True, True)
         pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
+        correct = pred.eq(target.view(1, -1).expand_as(pred)).float()
+        # Row k - 1 of the cumulative sum marks the samples that are correct within the top k
+        correct_cum = correct.cumsum(dim=0)
 
-        res = []
-        for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
-            res.append(correct_k.mul_(1.0 / batch_size))
-        return res
+        return [correct_cum[k - 1].sum(0, keepdim=True).mul_(1.0 / batch_size) for k in topk]
 
 
 if __name__ == '__main__':
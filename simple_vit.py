@@ -1,41 +1,21 @@
 import math
+import warnings
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from packaging import version
+from torch.utils.checkpoint import checkpoint
 from collections import OrderedDict, namedtuple
 from functools import partial
 from typing import Callable, Optional
-from einops import rearrange
-from torch.nn.attention import SDPBackend, sdpa_kernel
 
+assert version.parse(torch.__version__) >= version.parse('2.0.0'), 'in order to use flash attention, you must be using pytorch 2.0 or above'
 
 
-
-
-class Attend(nn.Module):
-    def __init__(self, use_flash=True):
-        super().__init__()
-        self.use_flash = use_flash
-        assert not (use_flash and version.parse(torch.__version__) < version.parse('2.0.0')), 'in order to use flash attention, you must be using pytorch 2.0 or above'
-
-    
-    def flash_attn(self, q, k, v):
-        with sdpa_kernel(SDPBackend.FLASH_ATTENTION):
-            out = F.scaled_dot_product_attention(q, k, v)
-
-        return out
-
-    def forward(self, q, k, v):
-        
-        return self.flash_attn(q, k, v)
-
-        # # Fall back to standard attention if flash attention is not available
-        # scale = q.shape[-1] ** -0.5
-        # sim = torch.matmul(q, k.transpose(-2, -1)) * scale
-        # attn = sim.softmax(dim=-1)
-        # out = torch.matmul(attn, v)
-        # return out
+def _dropout(p: float) -> nn.Module:
+    # nn.Dropout(0.0) still launches a kernel in training mode. Identity keeps the
+    # nn.Sequential indices (and hence state_dict keys) of the MLP unchanged.
+    return nn.Dropout(p) if p > 0 else nn.Identity()
 
 # Flash Attention Block to replace the standard EncoderBlock
 class EncoderBlock(nn.Module):
@@ -47,30 +27,37 @@ class EncoderBlock(nn.Module):
         dropout: float,
         attention_dropout: float,
         norm_layer: Callable[..., torch.nn.Module] = partial(nn.LayerNorm, eps=1e-6),
-        use_flash: bool = True,
     ):
         super().__init__()
         self.num_heads = num_heads
         self.head_dim = hidden_dim // num_heads
+        torch._assert(hidden_dim % num_heads == 0, f"hidden_dim {hidden_dim} must be divisible by num_heads {num_heads}")
+        # The fused SDPA kernels want head_dim % 8 == 0. Otherwise SDPA pads q, k and v up to the next
+        # multiple of 8 internally; the assert keeps that extra copy and wasted compute out of every layer
+        torch._assert(self.head_dim % 8 == 0, f"head_dim {self.head_dim} must be a multiple of 8")
+        if self.head_dim % 32:
+            # FlashAttention-2 kernels are instantiated for head_dim in steps of 32, anything in between is padded up
+            warnings.warn(f"head_dim {self.head_dim} is not a multiple of 32, attention will run at the cost of "
+                          f"head_dim {-(-self.head_dim // 32) * 32}. Consider 64 or 128.")
         
         # Attention block
         self.ln_1 = norm_layer(hidden_dim)
-        self.attend = Attend(use_flash=use_flash)
+        self.attention_dropout = attention_dropout
         
         # QKV projections
         self.to_qkv = nn.Linear(hidden_dim, hidden_dim * 3, bias=False)
         self.to_out = nn.Linear(hidden_dim, hidden_dim, bias=False)
         
-        self.dropout = nn.Dropout(dropout)
+        self.dropout = _dropout(dropout)
 
         # MLP block
         self.ln_2 = norm_layer(hidden_dim)
         self.mlp = nn.Sequential(
             nn.Linear(hidden_dim, mlp_dim),
             nn.GELU(),
-            nn.Dropout(dropout),
+            _dropout(dropout),
             nn.Linear(mlp_dim, hidden_dim),
-            nn.Dropout(dropout),
+            _dropout(dropout),
         )
         
         # Initialize weights similar to original implementation
@@ -79,18 +66,23 @@ class EncoderBlock(nn.Module):
         nn.init.uniform_(self.to_out.weight, -bound, bound)
 
     def forward(self, x: torch.Tensor):
+        b, n = x.shape[:2]
+
         # Layer norm and attention
         x_norm = self.ln_1(x)
         
-        # Project to q, k, v
-        qkv = self.to_qkv(x_norm).chunk(3, dim=-1)
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=self.num_heads), qkv)
+        # Project to q, k, v: (b, n, 3 * h * d) -> (3, b, h, n, d). q, k and v stay strided views
+        # into the single QKV GEMM output; SDPA only needs the last dim to be contiguous
+        qkv = self.to_qkv(x_norm).unflatten(-1, (3, self.num_heads, self.head_dim)).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)
         
-        # Apply attention
-        out = self.attend(q, k, v)
+        # Apply attention. No sdpa_kernel() context manager, so that SDPA (or Inductor under torch.compile)
+        # dispatches to the best fused backend: FlashAttention, cuDNN or memory-efficient
+        out = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=self.attention_dropout if self.training else 0.0, is_causal=False)
         
-        # Reshape and project to output
-        out = rearrange(out, 'b h n d -> b n (h d)')
+        # Reshape and project to output: (b, h, n, d) -> (b, n, h * d)
+        out = out.transpose(1, 2).reshape(b, n, self.num_heads * self.head_dim)
         out = self.to_out(out)
         out = self.dropout(out)
         
@@ -115,39 +107,51 @@ class Encoder(nn.Module):
         dropout: float,
         attention_dropout: float,
         norm_layer: Callable[..., torch.nn.Module] = partial(nn.LayerNorm, eps=1e-6),
-        use_flash: bool = True,
+        grad_checkpoint: bool = False,
     ):
         super().__init__()
-        self.dropout = nn.Dropout(dropout)
-        layers: OrderedDict[str, nn.Module] = OrderedDict()
-        for i in range(num_layers):
-            layers[f"encoder_layer_{i}"] = EncoderBlock(
+        self.grad_checkpoint = grad_checkpoint
+        self.dropout = _dropout(dropout)
+        self.layers = nn.ModuleList([
+            EncoderBlock(
                 num_heads,
                 hidden_dim,
                 mlp_dim,
                 dropout,
                 attention_dropout,
                 norm_layer,
-                use_flash,
-            )
-        self.layers = nn.Sequential(layers)
+                )
+            for _ in range(num_layers)
+        ])
         self.ln = norm_layer(hidden_dim)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved while self.layers was an nn.Sequential(OrderedDict) name the blocks
+        # "encoder_layer_{i}" instead of "{i}"
+        old_prefix = prefix + "layers.encoder_layer_"
+        for key in [k for k in state_dict if k.startswith(old_prefix)]:
+            state_dict[prefix + "layers." + key[len(old_prefix):]] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, input: torch.Tensor):
         torch._assert(input.dim() == 3, f"Expected (batch_size, seq_length, hidden_dim) got {input.shape}")
-        return self.ln(self.layers(self.dropout(input)))
+        x = self.dropout(input)
+        for blk in self.layers:
+            # Recompute the block's activations in backward instead of keeping them alive
+            x = checkpoint(blk, x, use_reentrant=False) if self.grad_checkpoint and self.training else blk(x)
+        return self.ln(x)
 
 # Position embedding function from the second implementation
-def posemb_sincos_2d(h, w, dim, temperature: int = 10000, dtype=torch.float32):
-    y, x = torch.meshgrid(torch.arange(h), torch.arange(w), indexing="ij")
+def posemb_sincos_2d(h, w, dim, temperature: int = 10000, dtype=torch.float32, device=None):
     assert (dim % 4) == 0, "feature dimension must be multiple of 4 for sincos emb"
-    omega = torch.arange(dim // 4) / (dim // 4 - 1)
+    omega = torch.arange(dim // 4, device=device, dtype=torch.float32) / (dim // 4 - 1)
     omega = 1.0 / (temperature ** omega)
 
-    y = y.flatten()[:, None] * omega[None, :]
-    x = x.flatten()[:, None] * omega[None, :]
+    # Broadcast (h, 1, d) and (1, w, d) over the (h, w) grid instead of materializing a meshgrid
+    y = (torch.arange(h, device=device, dtype=torch.float32)[:, None, None] * omega).expand(h, w, -1).reshape(h * w, -1)
+    x = (torch.arange(w, device=device, dtype=torch.float32)[None, :, None] * omega).expand(h, w, -1).reshape(h * w, -1)
     pe = torch.cat((x.sin(), x.cos(), y.sin(), y.cos()), dim=1)
-    return pe.type(dtype)
+    return pe.to(dtype)
 
 # Weight initialization function from the second implementation
 def jax_lecun_normal(layer, fan_in):
@@ -181,7 +185,7 @@ class SimpleVisionTransformer(nn.Module):
         pool_type: str = "gap",
         register: int = 0,
         norm_layer: Callable[..., torch.nn.Module] = partial(nn.LayerNorm, eps=1e-6),
-        use_flash: bool = True,
+        grad_checkpoint: bool = False,
     ):
         super().__init__()
         torch._assert(image_size % patch_size == 0, "Input shape indivisible by patch size!")
@@ -209,7 +213,7 @@ class SimpleVisionTransformer(nn.Module):
         h = w = image_size // patch_size
         seq_length = h * w
         if posemb == "sincos2d":
-            self.register_buffer("pos_embedding", posemb_sincos_2d(h=h, w=w, dim=hidden_dim))
+            self.register_buffer("pos_embedding", posemb_sincos_2d(h=h, w=w, dim=hidden_dim, device=self.conv_proj.weight.device))
         elif posemb == "learn":
             self.pos_embedding = self._learned_embeddings(seq_length)
         else:
@@ -224,7 +228,7 @@ class SimpleVisionTransformer(nn.Module):
             dropout,
             attention_dropout,
             norm_layer,
-            use_flash,
+            grad_checkpoint,
         )
         self.seq_length = seq_length
 
@@ -258,8 +262,9 @@ class SimpleVisionTransformer(nn.Module):
         n_h = h // p
         n_w = w // p
 
-        # (n, c, h, w) -> (n, hidden_dim, n_h, n_w)
-        x = self.conv_proj(x)
+        # (n, c, h, w) -> (n, hidden_dim, n_h, n_w). channels_last lets cuDNN use its NHWC tensor-core
+        # kernels, and makes the reshape + permute below a view; a no-op if x is already channels_last
+        x = self.conv_proj(x.contiguous(memory_format=torch.channels_last))
         # (n, hidden_dim, n_h, n_w) -> (n, hidden_dim, (n_h * n_w))
         x = x.reshape(n, self.hidden_dim, n_h * n_w)
 
@@ -272,17 +277,23 @@ class SimpleVisionTransformer(nn.Module):
         return x
 
     def _loss_fn(self, out: torch.Tensor, lam: float, target1: torch.Tensor, target2: torch.Tensor):
-        logprob = F.log_softmax(out, dim=1)
+        logprob = F.log_softmax(out.float(), dim=1)
         return lam * F.nll_loss(logprob, target1) + (1.0 - lam) * F.nll_loss(logprob, target2)
 
     def forward(self, x: torch.Tensor, lam: float = 1.0, target1: Optional[torch.Tensor] = None, target2: Optional[torch.Tensor] = None):
         # Reshape and permute the input tensor
         x = self._process_input(x)
         if self.pos_embedding is not None:
-            x = x + self.pos_embedding
+            if x.dtype == self.pos_embedding.dtype:
+                # x is a fresh conv_proj activation, add in place instead of allocating another (n, seq, hidden) tensor
+                x = x.add_(self.pos_embedding)
+            else:
+                # e.g. bfloat16 x under autocast, promote to keep the residual stream in float32
+                x = x + self.pos_embedding
         if self.register:
             n = x.shape[0]
-            x = torch.cat([torch.tile(self.reg, (n, 1, 1)), x], dim=1)
+            # expand() is a broadcast view, so cat() is the only copy of the registers
+            x = torch.cat([self.reg.expand(n, -1, -1), x], dim=1)
         x = self.encoder(x)
         if self.pool_type == 'tok':
             x = x[:, 0]
@@ -37,8 +37,11 @@ class TwoHotMixUp:
         labels = labels.reshape(self.prefetch_factor, self.batch_size)
         if self._dist:
             lam = self._dist.sample()    #.item()
-            images = images.roll(1, dims=1).mul_(1.0 - lam).add_(images, alpha=lam)
-            return images, lam, labels, labels.roll(1, dims=1)
+            # lerp_() into images keeps their (channels_last) layout, roll() would return a contiguous tensor
+            images = images.lerp_(images.roll(1, dims=1), 1.0 - float(lam))
+            # lam goes to the model as a device scalar: Inductor does not capture CUDA graphs
+            # for graphs with CPU tensor inputs
+            return images, lam.to(images.device, non_blocking=True), labels, labels.roll(1, dims=1)
         else:
             return images, 1, labels, labels
 
@@ -183,7 +186,68 @@ def _cutout(
     return F.erase(image, lower_pad, left_pad, cutout_shape[0], cutout_shape[1], torch.tensor(replace).unsqueeze(1).unsqueeze(1))
 
 
+def _to_device(tensor: torch.Tensor, device: torch.device) -> torch.Tensor:
+    # A copy from pageable host memory would synchronize the (side) stream, copy from pinned memory instead
+    if device.type == "cuda":
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
+
+
+def _cutout_batch(
+    images: torch.Tensor,
+    pad_size: int,
+    replace: int = 0,
+) -> torch.Tensor:
+    """_cutout() over a (N, C, H, W) batch, with the center sampled independently per image"""
+    n, _, img_h, img_w = images.shape
+    center_h = torch.randint(img_h, (n, 1, 1), device=images.device)
+    center_w = torch.randint(img_w, (n, 1, 1), device=images.device)
+    rows = torch.arange(img_h, device=images.device).view(1, -1, 1)
+    cols = torch.arange(img_w, device=images.device).view(1, 1, -1)
+    mask = ((rows >= center_h - pad_size) & (rows < center_h + pad_size)
+            & (cols >= center_w - pad_size) & (cols < center_w + pad_size))
+    replace = _to_device(torch.tensor(replace, dtype=images.dtype), images.device).view(1, -1, 1, 1)
+    return torch.where(mask.unsqueeze(1), replace, images)
+
+
 class RandAugment17(v2.RandAugment):
+    def forward_batch(self, images: torch.Tensor) -> torch.Tensor:
+        """Same as calling forward() on each image of a (N, C, H, W) batch, i.e. ops and signs are
+        sampled per image, but each round applies every (op, sign) drawn once to the group of images
+        that drew it, so that the cost is one batched call per group instead of one call per image.
+        """
+        height, width = images.shape[-2:]
+        keys = tuple(self._AUGMENTATION_SPACE.keys())
+        # Every round writes back into images in place, but the caller's batch must not be modified
+        images = images.clone()
+        signed = torch.tensor([self._AUGMENTATION_SPACE[key][1] for key in keys])
+        for _ in range(self.num_ops):
+            op_ids = torch.randint(len(keys), (images.shape[0],))
+            negate = torch.rand(images.shape[0]) <= 0.5
+            # Sort the images by (op, sign) on the host, so that every group is a contiguous slice of
+            # the gathered batch and the device only needs one index transfer per round
+            group_ids = op_ids * 2 + (negate & signed[op_ids])
+            group_ids, order = group_ids.sort(stable=True)
+            order = _to_device(order, images.device)
+            grouped = images.index_select(0, order)
+            start = 0
+            for group_id, count in zip(*(t.tolist() for t in group_ids.unique_consecutive(return_counts=True))):
+                transform_id = keys[group_id // 2]
+                magnitudes = self._AUGMENTATION_SPACE[transform_id][0](self.num_magnitude_bins, height, width)
+                magnitude = float(magnitudes[self.magnitude]) if magnitudes is not None else 0.0
+                if group_id % 2:
+                    magnitude = -magnitude
+                group = grouped[start:start + count]
+                if transform_id == "Cutout":
+                    group[:] = _cutout_batch(group, pad_size=int(magnitude), replace=_get_fill(self._fill, type(images)))
+                else:
+                    group[:] = self._apply_image_or_video_transform(
+                        group, transform_id, magnitude, interpolation=self.interpolation, fill=self._fill
+                    )
+                start += count
+            images.index_copy_(0, order, grouped)
+        return images
+
     def _apply_image_or_video_transform(
         self,
         image: ImageOrVideo,